@@ -6,12 +6,18 @@
 */
 module tb ();
 
-  // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // Dump the signals to a VCD file when built with DUMP_VCD=1. You can view it
+  // with gtkwave or surfer.
+`ifdef DUMP_VCD
+`ifndef VCD_FILE
+`define VCD_FILE "tb.vcd"
+`endif
   initial begin
-    $dumpfile("tb.vcd");
+    $dumpfile(`VCD_FILE);
     $dumpvars(0, tb);
     #1;
   end
+`endif
 
   // Wire up the inputs and outputs:
   reg clk;
@@ -22,6 +28,55 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // SPI clock for the cocotb SPI driver: 100 kHz on SCLK (ui_in[0]) while
+  // nCS (ui_in[2]) is held low, idling low otherwise. Any change on nCS
+  // restarts the generator, so the first SCLK rising edge always comes a
+  // full half period (5 us) after nCS falls.
+  reg spi_sclk;
+  initial spi_sclk = 1'b0;
+  always @(ui_in[2]) begin
+    disable spi_sclk_gen;
+    spi_sclk = 1'b0;
+  end
+  always begin : spi_sclk_gen
+    wait (!ui_in[2]);
+    #5000 spi_sclk = !spi_sclk;
+  end
+
+  // PWM output bit monitored by the cocotb PWM tests
+  wire pwm_out = uo_out[0];
+
+  // PWM sampler: on each rising edge of pwm_out, latch the high time and
+  // period (in clk cycles) of the period that just ended, and count edges.
+  reg pwm_out_q;
+  reg [31:0] pwm_high_count;
+  reg [31:0] pwm_period_count;
+  reg [31:0] dbg_high;
+  reg [31:0] dbg_period;
+  reg [31:0] dbg_edges;
+  always @(posedge clk) begin
+    if (!rst_n) begin
+      pwm_out_q <= 1'b0;
+      pwm_high_count <= 0;
+      pwm_period_count <= 0;
+      dbg_high <= 0;
+      dbg_period <= 0;
+      dbg_edges <= 0;
+    end else begin
+      pwm_out_q <= pwm_out;
+      if (pwm_out && !pwm_out_q) begin
+        dbg_high <= pwm_high_count;
+        dbg_period <= pwm_period_count;
+        dbg_edges <= dbg_edges + 1;
+        pwm_high_count <= 1;
+        pwm_period_count <= 1;
+      end else begin
+        pwm_high_count <= pwm_high_count + pwm_out;
+        pwm_period_count <= pwm_period_count + 1;
+      end
+    end
+  end
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -36,7 +91,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  ({ui_in[7:1], ui_in[0] | spi_sclk}),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path
@@ -4,23 +4,19 @@
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
+from cocotb.triggers import FallingEdge
 from cocotb.triggers import ClockCycles
-from cocotb.types import Logic
+from cocotb.triggers import Timer
+from cocotb.triggers import First
 from cocotb.types import LogicArray
+from cocotb.utils import get_sim_time
+from cocotb.utils import get_time_from_sim_steps
 
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
+# ui_in pins: SCLK on ui_in[0], COPI on ui_in[1], nCS on ui_in[2]
+COPI_SHIFT = 1
 
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
+# Idle ui_in value: CS high, COPI and SCLK low
+IDLE_UI = 0b100
 
 async def send_spi_transaction(dut, r_w, address, data):
     """
@@ -46,47 +42,21 @@ async def send_spi_transaction(dut, r_w, address, data):
         raise ValueError("Data must be 8-bit (0-255)")
     # Combine RW and address into first byte
     first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
+    # Shift out the first byte (RW + Address) then the second byte (Data), MSB first
+    bits = [(first_byte >> (7-i)) & 0x1 for i in range(8)] + [(data_int >> (7-i)) & 0x1 for i in range(8)]
+    # Start transaction - pull CS low with the first bit on COPI. SCLK is
+    # generated by tb.v while CS is low; COPI changes on its falling edges.
+    for bit in bits:
+        dut.ui_in.value = bit << COPI_SHIFT
+        # one SCLK period is 10 us, give up if tb.v stops generating it
+        timeout = Timer(20, units="us")
+        assert await First(FallingEdge(dut.spi_sclk), timeout) is not timeout, "Timed out waiting for SCLK falling edge, is nCS low?"
     # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
-
-@cocotb.test()
-async def test_spi(dut):
-    dut._log.info("Start SPI test")
+    dut.ui_in.value = IDLE_UI
+    await Timer(60, units="us")
 
+async def bringup(dut):
+    """Start the 10 MHz clock and reset the DUT with CS idle."""
     # Set the clock period to 100 ns (10 MHz)
     clock = Clock(dut.clk, 100, units="ns")
     cocotb.start_soon(clock.start())
@@ -94,120 +64,88 @@ async def test_spi(dut):
     # Reset
     dut._log.info("Reset")
     dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
+    dut.ui_in.value = IDLE_UI
     dut.rst_n.value = 0
     await ClockCycles(dut.clk, 5)
     dut.rst_n.value = 1
     await ClockCycles(dut.clk, 5)
 
+@cocotb.test()
+async def test_spi(dut):
+    dut._log.info("Start SPI test")
+
+    await bringup(dut)
+
     dut._log.info("Test project behavior")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
+    await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 1000) 
+    await Timer(100, units="us")
 
     dut._log.info("Write transaction, address 0x01, data 0xCC")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
+    await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
     assert dut.uio_out.value == 0xCC, f"Expected 0xCC, got {dut.uio_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x30 (invalid), data 0xAA")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x30, 0xAA)
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 1, 0x30, 0xAA)
+    await Timer(10, units="us")
 
     dut._log.info("Read transaction (invalid), address 0x00, data 0xBE")
-    ui_in_val = await send_spi_transaction(dut, 0, 0x30, 0xBE)
+    await send_spi_transaction(dut, 0, 0x30, 0xBE)
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
     
     dut._log.info("Read transaction (invalid), address 0x41 (invalid), data 0xEF")
-    ui_in_val = await send_spi_transaction(dut, 0, 0x41, 0xEF)
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 0, 0x41, 0xEF)
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x02, data 0xFF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x04, data 0xCF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0xFF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0x00")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0x01")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
+    await Timer(3, units="ms")
 
     dut._log.info("SPI test completed successfully")
 
 async def get_frequency(dut):
-    start = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(cocotb.utils.get_sim_time(units ="ns") - start > 1000000):
-            return -1
-
-        elif(dut.uo_out.value == 0):
-            break
+    # wait for a rising edge, giving up after 1 ms (0% or 100% duty)
+    timeout = Timer(1, units="ms")
+    if await First(RisingEdge(dut.pwm_out), timeout) is timeout:
+        return -1
 
-    # now low, wait for high
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(cocotb.utils.get_sim_time(units="ns") - start > 1000000):
-            return -1
+    # now high, time until the next rising edge
+    start_freq = get_sim_time()
+    await RisingEdge(dut.pwm_out)
 
-        elif(dut.uo_out.value != 0):
-            break
-
-    # now high wait for low
-    start_freq = cocotb.utils.get_sim_time(units="ns")
-
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(dut.uo_out.value == 0):
-            break
-
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(dut.uo_out.value != 0):
-            break
-
-    return (cocotb.utils.get_sim_time(units="ns") - start_freq) / 1E9
+    return get_time_from_sim_steps(get_sim_time() - start_freq, "ns") / 1E9
 
 @cocotb.test()
 async def test_pwm_freq(dut):
     # Write your test here
     dut._log.info("Beginning PWM freq test...")
 
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
+    await bringup(dut)
 
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
-
-    ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xFF)
-    ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xFF) 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF) 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x03, 0xFF) 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x80)
+    await send_spi_transaction(dut, 1, 0x00, 0xFF)
+    await send_spi_transaction(dut, 1, 0x01, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x02, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x03, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x04, 0x80)
 
     T = await get_frequency(dut)
     f = 1/T
@@ -217,34 +155,20 @@ async def test_pwm_freq(dut):
     dut._log.info("PWM Frequency test completed successfully")
 
 async def get_duty(dut):
-    T = await get_frequency(dut)
-    if(T == -1):
+    # let the tb.v sampler see a few PWM periods, two rising edges are
+    # needed for a full period at the current duty cycle
+    edges = int(dut.dbg_edges.value)
+    await Timer(1, units="ms")
+    if(int(dut.dbg_edges.value) - edges < 2):
         return 0 if dut.uo_out.value == 0 else 1 # 0.00 or 1.00 duty
 
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if (dut.uo_out.value == 0):
-            break
-
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(dut.uo_out.value != 0):
-            break
-            
-    start = cocotb.utils.get_sim_time(units="ns")
-
-    while True:
-        await ClockCycles(dut.clk, 1)
-        if(dut.uo_out.value == 0):
-            break
-
-    return ((cocotb.utils.get_sim_time(units="ns") - start) / 1E9)/T
+    return int(dut.dbg_high.value) / int(dut.dbg_period.value)
 
             
 async def run_duty(dut, percent):
     value = int(255 * percent)
 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, value)
+    await send_spi_transaction(dut, 1, 0x04, value)
 
     tested_duty = await get_duty(dut)
 
@@ -257,25 +181,12 @@ async def run_duty(dut, percent):
 async def test_pwm_duty(dut):
     # Write your test here
     dut._log.info("PWM Duty Cycle test beginning...")
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await bringup(dut)
 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xFF)
-    ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xFF) 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF) 
-    ui_in_val = await send_spi_transaction(dut, 1, 0x03, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x00, 0xFF)
+    await send_spi_transaction(dut, 1, 0x01, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x02, 0xFF) 
+    await send_spi_transaction(dut, 1, 0x03, 0xFF) 
     
     await run_duty(dut, 0)
     await run_duty(dut, 0.5)